@@ -1,29 +1,84 @@
 import os
 import re
+import time
 import uuid
-import json
 import shutil
 import zipfile
+import hashlib
+import queue
 import asyncio
 import tempfile
+import itertools
+import logging
 import subprocess
+import multiprocessing
+import orjson
 from pathlib import Path
-from typing import Optional, Literal, Dict
+from dataclasses import dataclass
+from typing import Optional, Literal, Dict, Deque, Set, Callable
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from fastapi import FastAPI, UploadFile, Form, File, HTTPException
-from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import FileResponse, RedirectResponse, ORJSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 
+try:
+    # ISA-L: deflate/inflate e CRC32 vetorizados, API compatível com zlib
+    from isal import isal_zlib as _fast_zlib
+    zipfile.zlib = _fast_zlib
+    zipfile.crc32 = _fast_zlib.crc32
+    _ZLIB_MAX_LEVEL = 3  # isal_zlib.compressobj dá ValueError acima disso
+except ImportError:
+    _ZLIB_MAX_LEVEL = 9
+
 # ---------- config ----------
 PORT = int(os.getenv("PORT", "8080"))
 MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "100"))
+MAX_TASKS = int(os.getenv("MAX_TASKS", "512"))
+# jobs finalizados (e o site.zip) somem depois disso
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+JANITOR_INTERVAL = 300
+# jobs convertendo ao mesmo tempo: o npm passa boa parte do tempo esperando rede/disco
+WORKER_CONCURRENCY = max(1, int(os.getenv("WORKER_CONCURRENCY", "2")))
 JOBS_ROOT = Path("/tmp/jobs")
 JOBS_ROOT.mkdir(parents=True, exist_ok=True)
+# cache do npm compartilhado entre jobs: tarballs baixados uma vez só
+NPM_CACHE = Path(os.getenv("NPM_CACHE", "/tmp/npm-cache"))
+NPM_CACHE.mkdir(parents=True, exist_ok=True)
+# PKG_MGR=pnpm instala com o store do pnpm (hardlinks entre jobs); sem pnpm no PATH, npm
+PKG_MGR = os.getenv("PKG_MGR", "npm")
+PNPM_STORE = Path(os.getenv("PNPM_STORE", "/tmp/pnpm-store"))
+# node_modules prontos por hash do lockfile: mesmo template do Lovable não reinstala.
+# Precisa estar no mesmo filesystem de JOBS_ROOT (restauração é por hardlink); NM_CACHE_MAX=0 desliga
+NM_CACHE = Path(os.getenv("NM_CACHE", "/tmp/nm-cache"))
+NM_CACHE.mkdir(parents=True, exist_ok=True)
+NM_CACHE_MAX = int(os.getenv("NM_CACHE_MAX", "16"))
+# site.zip prontos por (hash do upload, slug, versão do conversor): reenvio idêntico
+# não roda npm de novo. Mesmo filesystem de JOBS_ROOT (hardlink); SITE_CACHE_MAX=0 desliga
+SITE_CACHE = Path(os.getenv("SITE_CACHE", "/tmp/site-cache"))
+SITE_CACHE.mkdir(parents=True, exist_ok=True)
+SITE_CACHE_MAX = int(os.getenv("SITE_CACHE_MAX", "64"))
 
 TaskState = Literal["queued", "working", "done", "error"]
 
-class Task(BaseModel):
+# registro interno, mutado a cada etapa: dataclass simples, sem validação
+@dataclass(slots=True)
+class Task:
+    id: str
+    slug: str
+    state: TaskState
+    progress: int = 0
+    eta_seconds: Optional[int] = None
+    message: Optional[str] = None
+    download_url: Optional[str] = None
+    seq: int = 0
+    finished_at: Optional[float] = None
+    input_hash: Optional[str] = None
+
+# o que a API expõe em GET /tasks/{id} (schema do OpenAPI)
+class TaskStatus(BaseModel):
     id: str
     slug: str
     state: TaskState
@@ -33,11 +88,29 @@ class Task(BaseModel):
     download_url: Optional[str] = None
 
 TASKS: Dict[str, Task] = {}
+# ids finalizados em ordem de término: a evicção só faz popleft, sem varrer TASKS
+FINISHED: Deque[str] = deque()
 QUEUE: "asyncio.Queue[str]" = asyncio.Queue()
-WORKER_RUNNING = False
+WORKER_RUNNING = 0  # quantos worker_loop estão vivos
+# posição na fila em O(1): seq de entrada vs. seq do último job iniciado
+_ENQUEUE_SEQ = itertools.count()
+LAST_STARTED_SEQ = -1
+# jobs em execução: o status não precisa varrer TASKS pra saber
+RUNNING_IDS: Set[str] = set()
+
+# o pipeline (unzip, npm, varreduras, zip) é bloqueante: roda fora do event loop,
+# um processo por worker_loop
+EXECUTOR = ProcessPoolExecutor(max_workers=WORKER_CONCURRENCY)
+_MP_MANAGER = None
+
+# vai pro mesmo log do servidor
+_LOG = logging.getLogger("uvicorn.error")
+
+ProgressCb = Callable[[int, str], None]
+PROGRESS_MIN_INTERVAL = 0.2  # s; no máximo ~5 updates/s por job
 
 # ---------- app ----------
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.mount("/ui", StaticFiles(directory="static", html=True), name="ui")
 
 @app.get("/")
@@ -50,17 +123,88 @@ def healthz():
     return "ok"
 
 # ---------- utils ----------
-import json as _json
+
+# regexes usados a cada arquivo/config: compilados uma vez só
+_RE_VITE_BASE = re.compile(r'base\s*:\s*["\']\/[^"\']*\/["\']')
+# defineConfig({ ... }) e o do Lovable: defineConfig(({ mode }) => ({ ... })).
+# "=> {" é corpo de função, não objeto: fica de fora (e o sanity cobre)
+_RE_VITE_DEFINE = re.compile(r'(defineConfig\(\s*(?:\(\s*(?:\w+|\{[^}]*\})?\s*\)\s*=>\s*\(\s*)?\{\s*)')
+_RE_NEXT_BASEPATH = re.compile(r'basePath\s*:\s*["\'][^"\']*["\']')
+_RE_NEXT_ASSETPREFIX = re.compile(r'assetPrefix\s*:\s*["\'][^"\']*["\']')
+_RE_NEXT_CJS_EXPORT = re.compile(r'(module\.exports\s*=\s*\{)')
+_RE_NEXT_ESM_EXPORT = re.compile(r'(export\s+default\s*\{)')
+# ensure_hashrouter; <App/> e <App></App> numa alternação só
+_RE_RRD_IMPORT = re.compile(r'from\s+[\'"]react-router-dom[\'"]')
+_RE_NAMED_IMPORT = re.compile(r'import\s*{\s*')
+_RE_FIRST_IMPORT = re.compile(r'(^\s*import[^\n]*\n)', re.M)
+_RE_APP_ELEM = re.compile(r'(<App\s*/>|<App\s*>\s*</App\s*>)')
+# src/href com aspas duplas OU simples numa passada só
+# tudo em bytes: o arquivo nunca é decodificado/reencodificado
+_RE_HTML_ATTR = re.compile(rb'(src|href)\s*=\s*(?:"([^"]+)"|\'([^\']+)\')', re.I)
+_RE_CSS_URL = re.compile(rb'url\(([^)]+)\)', re.I)
+# caso comum do Vite/CRA: só /assets/ absoluto -> uma passada em bytes,
+# todas as variantes de aspas numa alternação só
+_RE_HTML_ASSET = re.compile(rb'((?:src|href)=["\'])/assets/')
+_RE_CSS_ASSET = re.compile(rb'(url\(["\']?)/assets/')
+# ainda há url(/...) depois do fast path? (barato: só procura, não substitui)
+_RE_CSS_ABS_PROBE = re.compile(rb'url\(\s*["\']?/', re.I)
+# a slug vai parar em configs JS, substituições de regex e no .htaccess
+_RE_SLUG = re.compile(r'[A-Za-z0-9_-]+')
 
 def read_json(p: Path) -> dict:
     try:
-        return _json.loads(p.read_text(encoding="utf-8"))
+        return orjson.loads(p.read_bytes())
     except Exception:
         return {}
 
+# nunca vale a pena descer nessas pastas do projeto enviado
+PRUNE_DIRS = frozenset({"node_modules", ".git"})
+# ... e na busca do package.json raiz também não nas saídas de build
+PRUNE_DIRS_ROOT_SEARCH = PRUNE_DIRS | {"dist", "build", "out", ".next"}
+
+def walk_files(root: Path, prune=frozenset()):
+    # os.scandir: is_dir/is_file vêm do próprio readdir, sem stat nem Path por entrada
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name not in prune:
+                        stack.append(e.path)
+                elif e.is_file():
+                    yield e
+
+ZIP_BUFSIZE = 1 << 20
+# JS/CSS já minificados: nível 6 comprime ~2% a mais pelo dobro de CPU
+# (ISA-L só aceita 0-3: fora da faixa do backend ativo, satura em vez de falhar todo job a 85%)
+ZIP_LEVEL = min(max(int(os.getenv("ZIP_LEVEL", "1")), 0), _ZLIB_MAX_LEVEL)
+
+# até aqui o membro é inflado em memória de uma vez; acima disso, em blocos
+UNZIP_WHOLE_MAX = 2 << 20
+
 def unzip_all(src_zip: Path, dest_dir: Path):
+    # extrai membro a membro com buffers de 1 MiB (extractall copia em blocos pequenos)
+    dest = os.path.abspath(dest_dir)
+    made = set()
     with zipfile.ZipFile(src_zip, "r") as z:
-        z.extractall(dest_dir)
+        for zi in z.infolist():
+            target = os.path.normpath(os.path.join(dest, zi.filename))
+            if not target.startswith(dest + os.sep):
+                continue  # zip slip: ignora entradas fora do destino
+            if zi.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            parent = os.path.dirname(target)
+            if parent not in made:
+                os.makedirs(parent, exist_ok=True)
+                made.add(parent)
+            if zi.file_size < UNZIP_WHOLE_MAX:
+                # pequenos: z.read infla o membro inteiro numa chamada só e grava de uma vez
+                with open(target, "wb") as dst:
+                    dst.write(z.read(zi))
+                continue
+            with z.open(zi) as src, open(target, "wb", buffering=ZIP_BUFSIZE) as dst:
+                shutil.copyfileobj(src, dst, ZIP_BUFSIZE)
 
 def has_dep(pkg: str, pkgjson: dict) -> bool:
     for key in ("dependencies", "devDependencies", "peerDependencies"):
@@ -68,50 +212,103 @@ def has_dep(pkg: str, pkgjson: dict) -> bool:
             return True
     return False
 
+_ROOT_CONFIGS = frozenset({"vite.config.ts", "vite.config.js", "next.config.js", "next.config.mjs"})
+
 def find_project_root(base: Path) -> Path:
-    cands = [p.parent for p in base.rglob("package.json") if "node_modules" not in p.parts]
-    if not cands:
+    # pontuação: +10 se tem config de vite/next, -1 por nível de profundidade.
+    # BFS por nível: quando nem um config no nível atual supera o melhor, para
+    best, best_score = None, 0
+    level, depth = [str(base)], 0
+    while level and (best is None or best_score < 10 - depth):
+        nxt = []
+        for d in level:
+            names = set()
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        if e.name not in PRUNE_DIRS_ROOT_SEARCH:
+                            nxt.append(e.path)
+                    else:
+                        names.add(e.name)
+            if "package.json" in names:
+                score = (10 if names & _ROOT_CONFIGS else 0) - depth
+                if best is None or score > best_score:
+                    best, best_score = d, score
+        level, depth = nxt, depth + 1
+    if best is None:
         raise FileNotFoundError("Não encontrei package.json no ZIP enviado.")
-    def score(d: Path):
-        s = 0
-        if any((d/f).exists() for f in ["vite.config.ts","vite.config.js","next.config.js","next.config.mjs"]):
-            s += 10
-        s -= len(d.parts)
-        return s
-    cands.sort(key=score, reverse=True)
-    return cands[0]
-
-def detect_framework(project_root: Path) -> str:
-    pkg = read_json(project_root / "package.json")
-    if (project_root / "vite.config.ts").exists() or (project_root / "vite.config.js").exists() or has_dep("vite", pkg):
+    return Path(best)
+
+class BuildCtx:
+    # estado de uma conversão: package.json/tsconfig.json lidos uma vez só
+    def __init__(self, root: Path):
+        self.root = root
+        self.pkg_path = root / "package.json"
+        self._pkg: Optional[dict] = None
+        self._use_ts: Optional[bool] = None
+        self._root_files: Optional[frozenset] = None
+
+    @property
+    def root_files(self) -> frozenset:
+        # nomes dos arquivos da raiz num scandir só: os testes de config/tsconfig
+        # viram lookup em set em vez de um stat cada
+        if self._root_files is None:
+            with os.scandir(self.root) as it:
+                self._root_files = frozenset(e.name for e in it if not e.is_dir())
+        return self._root_files
+
+    @property
+    def pkg(self) -> dict:
+        if self._pkg is None:
+            self._pkg = read_json(self.pkg_path)
+        return self._pkg
+
+    def write_pkg(self, pkg: dict):
+        self.pkg_path.write_bytes(orjson.dumps(pkg, option=orjson.OPT_INDENT_2))
+        self._pkg = pkg
+
+    @property
+    def use_ts(self) -> bool:
+        if self._use_ts is None:
+            src = self.root / "src"
+            self._use_ts = "tsconfig.json" in self.root_files or (
+                src.is_dir() and any(".ts" in e.name for e in walk_files(src, prune=PRUNE_DIRS)))
+        return self._use_ts
+
+def detect_framework(ctx: BuildCtx) -> str:
+    files, pkg = ctx.root_files, ctx.pkg
+    if "vite.config.ts" in files or "vite.config.js" in files or has_dep("vite", pkg):
         return "vite"
-    if has_dep("next", pkg) or (project_root / "next.config.js").exists() or (project_root / "next.config.mjs").exists():
+    if has_dep("next", pkg) or "next.config.js" in files or "next.config.mjs" in files:
         return "next"
     if has_dep("react-scripts", pkg):
         return "cra"
     return "unknown"
 
 def patch_file_text(path: Path, transform):
-    if not path.exists():
+    # lê uma vez só em bytes (sem exists() antes nem releitura no fallback latin-1)
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
         return False
     try:
-        txt = path.read_text(encoding="utf-8")
+        txt = raw.decode("utf-8")
     except UnicodeDecodeError:
-        txt = path.read_text(encoding="latin-1")
+        txt = raw.decode("latin-1")
     new = transform(txt)
     if new != txt:
-        path.write_text(new, encoding="utf-8")
+        path.write_bytes(new.encode("utf-8"))
         return True
     return False
 
-def ensure_vite_config(project_root: Path, slug: str):
-    pkg = read_json(project_root / "package.json")
-    use_ts = (project_root / "tsconfig.json").exists() or any((project_root/"src").glob("**/*.ts*"))
-    fname = "vite.config.ts" if use_ts else "vite.config.js"
-    p = project_root / fname
+def ensure_vite_config(ctx: BuildCtx, slug: str) -> bool:
+    # True só se o config terminou com base '/slug/' (senão o sanity ainda precisa rodar)
+    pkg = ctx.pkg
+    fname = "vite.config.ts" if ctx.use_ts else "vite.config.js"
+    p = ctx.root / fname
     imports = "import react from '@vitejs/plugin-react'\n" if has_dep("@vitejs/plugin-react", pkg) else ""
     plugin = "  plugins: [react()],\n" if imports else ""
-    if not p.exists():
+    if fname not in ctx.root_files:
         p.write_text(
             "import { defineConfig } from 'vite'\n"
             f"{imports}\n"
@@ -121,43 +318,44 @@ def ensure_vite_config(project_root: Path, slug: str):
             "})\n", encoding="utf-8")
         return True
     desired = f'"/{slug}/"'
+    applied = False
     def transform(txt: str) -> str:
-        out, n = re.subn(r'base\s*:\s*["\']\/[^"\']*\/["\']', f'base: {desired}', txt)
+        nonlocal applied
+        out, n = _RE_VITE_BASE.subn(f'base: {desired}', txt)
         if n == 0:
-            out = re.sub(r'(defineConfig\(\s*(?:\(\s*\w+\s*\)\s*=>\s*)?\{\s*)',
-                         r'\1base: ' + desired + ', ', txt, count=1)
+            out, n = _RE_VITE_DEFINE.subn(r'\1base: ' + desired + ', ', txt, count=1)
+        applied = n > 0
         return out
-    return patch_file_text(p, transform)
+    patch_file_text(p, transform)
+    return applied
 
-def patch_next(project_root: Path, slug: str):
+def patch_next(ctx: BuildCtx, slug: str):
     for fname in ("next.config.js","next.config.mjs"):
-        p = project_root / fname
-        if p.exists():
+        if fname in ctx.root_files:
+            p = ctx.root / fname
             def t(txt: str) -> str:
                 if "basePath" in txt or "assetPrefix" in txt:
-                    t1 = re.sub(r'basePath\s*:\s*["\'][^"\']*["\']', f'basePath: "/{slug}"', txt)
-                    t1 = re.sub(r'assetPrefix\s*:\s*["\'][^"\']*["\']', f'assetPrefix: "/{slug}/"', t1)
+                    t1 = _RE_NEXT_BASEPATH.sub(f'basePath: "/{slug}"', txt)
+                    t1 = _RE_NEXT_ASSETPREFIX.sub(f'assetPrefix: "/{slug}/"', t1)
                     return t1
-                t1 = re.sub(r'(module\.exports\s*=\s*\{)', r'\1\n  basePath: "/%s",\n  assetPrefix: "/%s/",' % (slug, slug), txt, count=1)
-                t1 = re.sub(r'(export\s+default\s*\{)', r'\1\n  basePath: "/%s",\n  assetPrefix: "/%s/",' % (slug, slug), t1, count=1)
+                t1 = _RE_NEXT_CJS_EXPORT.sub(r'\1\n  basePath: "/%s",\n  assetPrefix: "/%s/",' % (slug, slug), txt, count=1)
+                t1 = _RE_NEXT_ESM_EXPORT.sub(r'\1\n  basePath: "/%s",\n  assetPrefix: "/%s/",' % (slug, slug), t1, count=1)
                 return t1
             patch_file_text(p, t)
             # garante export estável
-            pkg_path = project_root / "package.json"
-            pkg = read_json(pkg_path)
+            pkg = ctx.pkg
             scripts = pkg.get("scripts", {})
             scripts["export"] = "next build && next export -o dist"
             pkg["scripts"] = scripts
-            pkg_path.write_text(json.dumps(pkg, indent=2, ensure_ascii=False))
+            ctx.write_pkg(pkg)
             return True
     return False
 
-def patch_cra_homepage(project_root: Path, slug: str):
-    pkg_path = project_root / "package.json"
-    pkg = read_json(pkg_path)
+def patch_cra_homepage(ctx: BuildCtx, slug: str):
+    pkg = ctx.pkg
     if pkg.get("homepage") != f"/{slug}":
         pkg["homepage"] = f"/{slug}"
-        pkg_path.write_text(json.dumps(pkg, indent=2, ensure_ascii=False))
+        ctx.write_pkg(pkg)
         return True
     return False
 
@@ -167,49 +365,165 @@ def ensure_hashrouter(src_dir: Path):
         if p.exists():
             def transform(txt: str) -> str:
                 t = txt
-                if re.search(r'from\s+[\'"]react-router-dom[\'"]', t) and "HashRouter" not in t:
-                    t = re.sub(r'import\s*{\s*', 'import { HashRouter, ', t, count=1)
+                if _RE_RRD_IMPORT.search(t) and "HashRouter" not in t:
+                    t = _RE_NAMED_IMPORT.sub('import { HashRouter, ', t, count=1)
                 elif "react-router-dom" not in t:
-                    t = re.sub(r'(^\s*import[^\n]*\n)', r'\1import { HashRouter } from "react-router-dom";\n', t, count=1, flags=re.M)
+                    t = _RE_FIRST_IMPORT.sub(r'\1import { HashRouter } from "react-router-dom";\n', t, count=1)
                 t = t.replace("BrowserRouter", "HashRouter")
-                t = re.sub(r'(<App\s*/>)', r'<HashRouter>\1</HashRouter>', t)
-                t = re.sub(r'(<App\s*>\s*</App\s*>)', r'<HashRouter>\1</HashRouter>', t)
+                t = _RE_APP_ELEM.sub(r'<HashRouter>\1</HashRouter>', t)
                 return t
             patch_file_text(p, transform)
             return True
     return False
 
+# só a slug muda: o resto do .htaccess já fica pronto em bytes
+_HTACCESS_HEAD = (
+    b"DirectoryIndex index.html\n"
+    b"RewriteEngine On\n"
+    b"RewriteBase /"
+)
+_HTACCESS_TAIL = (
+    b"/\n\n"
+    b"RewriteCond %{REQUEST_FILENAME} -f [OR]\n"
+    b"RewriteCond %{REQUEST_FILENAME} -d\n"
+    b"RewriteRule ^ - [L]\n\n"
+    b"RewriteRule . index.html [L]\n"
+)
+
 def write_htaccess(target_dir: Path, slug: str):
-    rules = (
-        "DirectoryIndex index.html\n"
-        "RewriteEngine On\n"
-        f"RewriteBase /{slug}/\n\n"
-        "RewriteCond %{REQUEST_FILENAME} -f [OR]\n"
-        "RewriteCond %{REQUEST_FILENAME} -d\n"
-        "RewriteRule ^ - [L]\n\n"
-        "RewriteRule . index.html [L]\n"
-    )
-    (target_dir / ".htaccess").write_text(rules, encoding="utf-8")
-
-def run_cmd(cmd, cwd: Path):
-    subprocess.check_call(cmd, cwd=str(cwd))
-
-def npm_build(project_root: Path, framework: str) -> Path:
-    # instala deps
-    if (project_root / "package-lock.json").exists():
-        try:
-            run_cmd(["npm", "ci"], project_root)
-        except subprocess.CalledProcessError:
-            run_cmd(["npm", "install"], project_root)
-    else:
-        run_cmd(["npm", "install"], project_root)
+    (target_dir / ".htaccess").write_bytes(_HTACCESS_HEAD + slug.encode() + _HTACCESS_TAIL)
+
+NPM_ENV = {
+    **os.environ,
+    "npm_config_cache": str(NPM_CACHE),
+    "npm_config_prefer_offline": "true",
+    "npm_config_audit": "false",
+    "npm_config_fund": "false",
+    "npm_config_update_notifier": "false",
+}
+# sem --ignore-scripts: esbuild/swc/sharp dependem de postinstall pra achar o binário
+NPM_INSTALL_FLAGS = ["--prefer-offline", "--no-audit", "--no-fund", "--loglevel=error"]
+
+def run_cmd(cmd, cwd: Path, env: Optional[dict] = None):
+    subprocess.check_call(cmd, cwd=str(cwd), env=env)
+
+def pnpm_install(project_root: Path) -> bool:
+    # True se instalou; False pra cair no npm
+    if PKG_MGR != "pnpm" or not shutil.which("pnpm"):
+        return False
+    flags = ["--prefer-offline", "--store-dir", str(PNPM_STORE)]
+    try:
+        # export do Lovable vem com package-lock: o pnpm import converte e as versões ficam travadas
+        if not (project_root / "pnpm-lock.yaml").exists() and (project_root / "package-lock.json").exists():
+            run_cmd(["pnpm", "import"], project_root, NPM_ENV)
+        if (project_root / "pnpm-lock.yaml").exists():
+            flags.append("--frozen-lockfile")
+        run_cmd(["pnpm", "install", *flags], project_root, NPM_ENV)
+        return True
+    except subprocess.CalledProcessError:
+        # node_modules do pnpm (symlinks) atrapalha o npm: começa do zero
+        shutil.rmtree(project_root / "node_modules", ignore_errors=True)
+        return False
+
+# caches que o build escreve dentro do node_modules: não vão pro NM_CACHE,
+# senão o build seguinte escreveria por cima de arquivos compartilhados.
+# ATENÇÃO: o node_modules restaurado é hardlink do cache (mesmo inode). Qualquer passo
+# do build que reescreva NO LUGAR um arquivo já existente do node_modules fora destas
+# pastas corrompe o cache pra todos os jobs seguintes; se aparecer outro, entra aqui
+_NM_VOLATILE = (".cache", ".vite")
+# só o que muda a árvore instalada: homepage/scripts patchados por job ficam de fora
+_NM_KEY_SECTIONS = ("dependencies", "devDependencies", "optionalDependencies",
+                    "peerDependencies", "overrides", "resolutions", "pnpm")
+# hooks do próprio projeto: no cache hit o install não roda, então eles também não
+# (patch-package, prisma generate...): projeto com algum deles não usa o NM_CACHE
+_NM_LIFECYCLE = ("preinstall", "install", "postinstall", "prepare")
+
+def nm_cache_key(ctx: BuildCtx) -> Optional[str]:
+    if NM_CACHE_MAX <= 0:
+        return None  # NM_CACHE_MAX=0 desliga
+    # sem lockfile a árvore instalada não é determinística: não cacheia
+    lock = next((n for n in ("package-lock.json", "pnpm-lock.yaml") if n in ctx.root_files), None)
+    if lock is None:
+        return None
+    # deps file:/link: viram symlinks pra dentro do próprio projeto: não dá pra compartilhar
+    pkg = ctx.pkg
+    for sec in ("dependencies", "devDependencies"):
+        if any(str(v).startswith(("file:", "link:", "workspace:")) for v in (pkg.get(sec) or {}).values()):
+            return None
+    scripts = pkg.get("scripts") or {}
+    if any(hook in scripts for hook in _NM_LIFECYCLE):
+        return None
+    h = hashlib.blake2b(PKG_MGR.encode(), digest_size=16)
+    h.update((ctx.root / lock).read_bytes())
+    h.update(orjson.dumps({sec: pkg[sec] for sec in _NM_KEY_SECTIONS if sec in pkg},
+                          option=orjson.OPT_SORT_KEYS))
+    return h.hexdigest()
+
+def nm_cache_restore(project_root: Path, key: str) -> bool:
+    src = NM_CACHE / key
+    dst = project_root / "node_modules"
+    if not src.is_dir() or dst.exists():
+        return False
+    try:
+        # hardlinks: nenhum byte copiado, só entradas de diretório
+        shutil.copytree(src, dst, symlinks=True, copy_function=os.link)
+    except OSError:
+        shutil.rmtree(dst, ignore_errors=True)
+        return False
+    os.utime(src)  # mtime = último uso, pra evicção
+    return True
+
+def nm_cache_store(project_root: Path, key: str):
+    dst = NM_CACHE / key
+    if dst.exists():
+        return
+    # monta ao lado e renomeia: outro worker com o mesmo hash nunca vê cache pela metade
+    tmp = NM_CACHE / f".{key}.{os.getpid()}"
+    try:
+        shutil.copytree(project_root / "node_modules", tmp, symlinks=True, copy_function=os.link,
+                        ignore=shutil.ignore_patterns(*_NM_VOLATILE))
+        os.rename(tmp, dst)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    # LRU simples pelo mtime. Best-effort: o outro processo do pool pode estar
+    # apagando as mesmas entradas, e o install em si já deu certo
+    entries = []
+    try:
+        for e in os.scandir(NM_CACHE):
+            if not e.name.startswith("."):
+                try:
+                    entries.append((e.stat().st_mtime, e.path))
+                except OSError:
+                    pass
+    except OSError:
+        return
+    entries.sort()
+    for _, path in entries[:-NM_CACHE_MAX]:
+        shutil.rmtree(path, ignore_errors=True)
+
+def npm_build(ctx: BuildCtx, framework: str) -> Path:
+    project_root = ctx.root
+    # instala deps (ou reaproveita o node_modules de um job com o mesmo lockfile)
+    key = nm_cache_key(ctx)
+    if not (key and nm_cache_restore(project_root, key)):
+        if not pnpm_install(project_root):
+            if (project_root / "package-lock.json").exists():
+                try:
+                    run_cmd(["npm", "ci", *NPM_INSTALL_FLAGS], project_root, NPM_ENV)
+                except subprocess.CalledProcessError:
+                    run_cmd(["npm", "install", *NPM_INSTALL_FLAGS], project_root, NPM_ENV)
+            else:
+                run_cmd(["npm", "install", *NPM_INSTALL_FLAGS], project_root, NPM_ENV)
+        if key:
+            nm_cache_store(project_root, key)
 
     # build/export
     if framework == "next":
-        run_cmd(["npm", "run", "export"], project_root)
+        run_cmd(["npm", "run", "export"], project_root, NPM_ENV)
         out = project_root / "dist"
     else:
-        run_cmd(["npm", "run", "build"], project_root)
+        run_cmd(["npm", "run", "build"], project_root, NPM_ENV)
         out = None
         for cand in ["dist","build","out"]:
             if (project_root / cand).exists():
@@ -219,67 +533,139 @@ def npm_build(project_root: Path, framework: str) -> Path:
             raise RuntimeError("Build não gerou pasta dist/build/out.")
     return out
 
-def sanity_html_css(dist_dir: Path):
-    # Corrige URLs absolutas que quebram sob subcaminho
-    for htmlp in dist_dir.rglob("*.html"):
-        s = htmlp.read_text(encoding="utf-8", errors="ignore")
-        def repl_attr(m):
-            attr, q, url = m.group(1), m.group(2), m.group(3)
-            if url and not re.match(r'^(https?:)?//|data:|mailto:|tel:', url) and url.startswith("/"):
-                url = url.lstrip("/")
-            return f'{attr}={q}{url}{q}'
-        s2 = re.sub(r'(src|href)\s*=\s*(")([^"]+)(")', repl_attr, s, flags=re.I)
-        s2 = re.sub(r'(src|href)\s*=\s*(\')([^\']+)(\')', repl_attr, s2, flags=re.I)
-        if s2 != s:
-            htmlp.write_text(s2, encoding="utf-8")
-    for cssp in dist_dir.rglob("*.css"):
-        s = cssp.read_text(encoding="utf-8", errors="ignore")
-        def repl_url(m):
-            inner = m.group(1).strip().strip('"').strip("'")
-            if inner and not re.match(r'^(https?:)?//|data:', inner) and inner.startswith("/"):
-                inner = inner.lstrip("/")
-            if '"' in m.group(1):
-                return f'url("{inner}")'
-            if "'" in m.group(1):
-                return f"url('{inner}')"
-            return f'url({inner})'
-        s2 = re.sub(r'url\(([^)]+)\)', repl_url, s, flags=re.I)
-        if s2 != s:
-            cssp.write_text(s2, encoding="utf-8")
-
-def zip_with_perms(src_dir: Path, out_zip: Path):
+def _repl_html_attr(m):
+    attr = m.group(1)
+    q, url = (b'"', m.group(2)) if m.group(2) is not None else (b"'", m.group(3))
+    # de http:, https:, //, data:, mailto: e tel:, só "//" começa com "/":
+    # duas comparações de prefixo bastam, sem regex por URL
+    if url.startswith(b"/") and not url.startswith(b"//"):
+        url = url.lstrip(b"/")
+    return attr + b"=" + q + url + q
+
+def _repl_css_url(m):
+    inner = m.group(1).strip().strip(b'"').strip(b"'")
+    if inner.startswith(b"/") and not inner.startswith(b"//"):
+        inner = inner.lstrip(b"/")
+    if b'"' in m.group(1):
+        return b'url("' + inner + b'")'
+    if b"'" in m.group(1):
+        return b"url('" + inner + b"')"
+    return b"url(" + inner + b")"
+
+def fix_html_bytes(raw: bytes) -> bytes:
+    # memmem antes do regex: arquivo sem /assets/ nem aloca cópia
+    out = _RE_HTML_ASSET.sub(rb'\1assets/', raw) if b"/assets/" in raw else raw
+    # sobrou alguma URL começando com "/"? só então roda o regex genérico
+    if b'"/' in out or b"'/" in out:
+        out = _RE_HTML_ATTR.sub(_repl_html_attr, out)
+    return out
+
+def fix_css_bytes(raw: bytes) -> bytes:
+    out = _RE_CSS_ASSET.sub(rb'\1assets/', raw) if b"/assets/" in raw else raw
+    if _RE_CSS_ABS_PROBE.search(out):
+        out = _RE_CSS_URL.sub(_repl_css_url, out)
+    return out
+
+def fix_asset_file(path: str) -> Optional[bytes]:
+    # devolve o conteúdo corrigido, ou None se o arquivo já está certo
+    with open(path, "rb") as fh:
+        raw = fh.read()
+    out = fix_css_bytes(raw) if path.lower().endswith(".css") else fix_html_bytes(raw)
+    return out if out != raw else None
+
+def scan_dist(dist_dir: Path):
+    # uma travessia só do dist, em pré-ordem e ordenada: (arcname, caminho, é_pasta);
+    # a mesma lista serve ao sanity e ao zip
+    out = []
+    stack = [(str(dist_dir), "")]
+    while stack:
+        path, prefix = stack.pop()
+        if prefix:
+            out.append((prefix, path, True))
+        with os.scandir(path) as it:
+            ents = sorted(it, key=lambda e: e.name)
+        subdirs = []
+        for e in ents:
+            if e.is_dir():
+                subdirs.append((e.path, prefix + e.name + "/"))
+            else:
+                out.append((prefix + e.name, e.path, False))
+        stack.extend(reversed(subdirs))
+    return out
+
+def sanity_html_css(entries, under: str = "", recursive: bool = True) -> Dict[str, bytes]:
+    # Corrige URLs absolutas que quebram sob subcaminho. Não grava no disco:
+    # devolve {caminho: bytes corrigidos} e o zip_with_perms escreve direto no zip
+    paths = [path for arc, path, is_dir in entries
+             if not is_dir and arc.startswith(under)
+             and (recursive or "/" not in arc[len(under):])
+             and arc.lower().endswith((".html", ".htm", ".css"))]
+    # arquivos independentes: I/O e regex (C) liberam o GIL
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as ex:
+        return {p: out for p, out in zip(paths, ex.map(fix_asset_file, paths)) if out is not None}
+
+_INCOMPRESSIBLE = {
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".ico",
+    ".woff", ".woff2", ".gz", ".br", ".zip", ".mp4", ".webm", ".mp3",
+}
+
+def zip_with_perms(entries, out_zip: Path, patched: Optional[Dict[str, bytes]] = None):
     # Zip com arquivos na RAIZ (index.html na raiz da slug)
+    patched = patched or {}
     out_zip.parent.mkdir(parents=True, exist_ok=True)
-    with zipfile.ZipFile(out_zip, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        # pastas
-        for d in sorted([p for p in src_dir.rglob("*") if p.is_dir()]):
-            rel = d.relative_to(src_dir).as_posix().rstrip("/") + "/"
-            zi = zipfile.ZipInfo(rel)
-            zi.external_attr = (0o755 & 0xFFFF) << 16
-            z.writestr(zi, b"")
-        # arquivos
-        for f in src_dir.rglob("*"):
-            if f.is_file():
-                rel = f.relative_to(src_dir).as_posix()
-                zi = zipfile.ZipInfo(rel)
+    with zipfile.ZipFile(out_zip, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL,
+                         strict_timestamps=False) as z:
+        # entries em pré-ordem (scan_dist): cada pasta entra no zip antes do seu conteúdo
+        for arc, f, is_dir in entries:
+            # pastas: ZipFile.mkdir (3.11+) já marca S_IFDIR e o bit de diretório do DOS
+            if is_dir:
+                z.mkdir(arc, 0o755)
+            # arquivos
+            else:
+                zi = zipfile.ZipInfo(arc)
                 zi.external_attr = (0o644 & 0xFFFF) << 16
-                with open(f, "rb") as fh:
-                    z.writestr(zi, fh.read())
+                # já comprimidos: deflate só gastaria CPU
+                zi.compress_type = zipfile.ZIP_STORED if os.path.splitext(arc)[1].lower() in _INCOMPRESSIBLE else zipfile.ZIP_DEFLATED
+                if f in patched:
+                    # HTML/CSS corrigido pelo sanity: já está em memória, não relê do disco
+                    z.writestr(zi, patched[f], compresslevel=ZIP_LEVEL)
+                    continue
+                with open(f, "rb", buffering=0) as fh:
+                    # fstat no fd já aberto, sem resolver o caminho de novo
+                    size = os.fstat(fh.fileno()).st_size
+                    if size <= ZIP_BUFSIZE:
+                        # a maioria: uma leitura e um writestr
+                        z.writestr(zi, fh.read(), compresslevel=ZIP_LEVEL)
+                        continue
+                    # tamanho conhecido de antemão: o zipfile decide sozinho se precisa de zip64
+                    zi.file_size = size
+                    # ZipInfo próprio não herda o compresslevel do ZipFile e o open("w") não
+                    # aceita compresslevel: _compresslevel é interno do CPython (o writestr faz igual)
+                    zi._compresslevel = ZIP_LEVEL
+                    # copia em blocos de 1 MiB direto pro zip, sem carregar o arquivo inteiro
+                    with z.open(zi, "w") as dst:
+                        shutil.copyfileobj(fh, dst, ZIP_BUFSIZE)
 
-def convert_lovable_zip(input_zip: Path, slug: str, work_dir: Path) -> Path:
+def convert_lovable_zip(input_zip: Path, slug: str, work_dir: Path,
+                        progress: Optional[ProgressCb] = None) -> Path:
+    progress = progress or (lambda pct, msg: None)
     src_dir = work_dir / "src"
     src_dir.mkdir(parents=True, exist_ok=True)
+    progress(15, "Extraindo ZIP...")
     unzip_all(input_zip, src_dir)
 
+    progress(25, "Aplicando ajustes (slug/roteamento)...")
     project_root = find_project_root(src_dir)
-    fw = detect_framework(project_root)
+    ctx = BuildCtx(project_root)
+    fw = detect_framework(ctx)
 
+    vite_base = False
     if fw == "vite":
-        ensure_vite_config(project_root, slug)
+        vite_base = ensure_vite_config(ctx, slug)
     elif fw == "next":
-        patch_next(project_root, slug)
+        patch_next(ctx, slug)
     elif fw == "cra":
-        patch_cra_homepage(project_root, slug)
+        patch_cra_homepage(ctx, slug)
 
     # HashRouter para SPA
     for cand in ["src","app","frontend/src"]:
@@ -288,19 +674,212 @@ def convert_lovable_zip(input_zip: Path, slug: str, work_dir: Path) -> Path:
             ensure_hashrouter(p)
             break
 
-    dist_dir = npm_build(project_root, fw)
+    progress(35, "Instalando dependências e gerando build (npm)...")
+    dist_dir = npm_build(ctx, fw)
 
-    sanity_html_css(dist_dir)
+    progress(75, "Ajustes finais...")
     write_htaccess(dist_dir, slug)
+    entries = scan_dist(dist_dir)
+    # Vite com base '/slug/' aplicada já sai certo; Next só precisa olhar _next/, CRA o HTML da raiz
+    patched = {}
+    if fw == "next":
+        patched = sanity_html_css(entries, under="_next/")
+    elif fw == "cra":
+        patched = sanity_html_css(entries, recursive=False)
+    elif not vite_base:
+        # inclui Vite cujo config não deu pra patchear: /assets/ absoluto vira relativo
+        patched = sanity_html_css(entries)
 
+    progress(85, "Gerando site.zip...")
     out_zip = work_dir / "site.zip"
-    zip_with_perms(dist_dir, out_zip)
+    zip_with_perms(entries, out_zip, patched)
     return out_zip
 
 # ---------- worker ----------
+def _progress_manager():
+    global _MP_MANAGER
+    if _MP_MANAGER is None:
+        _MP_MANAGER = multiprocessing.Manager()
+    return _MP_MANAGER
+
+class _ProgressSender:
+    # roda no processo do EXECUTOR; cada put é um round-trip IPC com o Manager,
+    # então ticks repetidos (mesma mensagem, < PROGRESS_MIN_INTERVAL) são descartados
+    def __init__(self, q):
+        self.q = q
+        self.last_ts = 0.0
+        self.last_msg = None
+
+    def __call__(self, pct: int, msg: str):
+        now = time.monotonic()
+        if pct < 100 and msg == self.last_msg and now - self.last_ts < PROGRESS_MIN_INTERVAL:
+            return
+        self.last_ts, self.last_msg = now, msg
+        self.q.put((pct, msg))
+
+async def run_conversion(task: Task, input_zip: Path, work_dir: Path) -> Path:
+    loop = asyncio.get_running_loop()
+    q = _progress_manager().Queue()
+    fut = loop.run_in_executor(
+        EXECUTOR, convert_lovable_zip, input_zip, task.slug, work_dir,
+        _ProgressSender(q))
+    while True:
+        done, _ = await asyncio.wait({fut}, timeout=0.5)
+        # repassa o progresso publicado pelo processo do EXECUTOR; só o último
+        # tick do lote importa, e cada chamada ao proxy é um round-trip IPC
+        last = None
+        while True:
+            try:
+                last = q.get_nowait()
+            except queue.Empty:
+                break
+        if last is not None:
+            task.progress, task.message = last
+        if done:
+            return fut.result()
+
+def save_task(task: Task):
+    # estado em JOBS_ROOT/<id>/task.json a cada transição (não a cada tick de progresso),
+    # pra sobreviver a restart; tmp + replace: nunca fica um JSON pela metade
+    p = JOBS_ROOT / task.id / "task.json"
+    tmp = p.with_suffix(".tmp")
+    tmp.write_bytes(orjson.dumps(task))
+    os.replace(tmp, p)
+
+def load_tasks():
+    # reconstrói TASKS/FINISHED/QUEUE a partir do disco; roda no startup, antes dos workers
+    found = []
+    for e in os.scandir(JOBS_ROOT):
+        if not e.is_dir():
+            continue
+        try:
+            found.append(Task(**orjson.loads(Path(e.path, "task.json").read_bytes())))
+        except (OSError, ValueError, TypeError):
+            continue
+    finished = sorted((t for t in found if t.state in ("done", "error")), key=lambda t: t.finished_at or 0)
+    pending = sorted((t for t in found if t.state in ("queued", "working")), key=lambda t: t.seq)
+    for task in finished:
+        TASKS[task.id] = task
+        FINISHED.append(task.id)
+        # restart entre o done e a limpeza: sobra o input.zip
+        Path(JOBS_ROOT, task.id, "input.zip").unlink(missing_ok=True)
+    for task in pending:
+        job_dir = JOBS_ROOT / task.id
+        # sobras do work dir de um job interrompido no meio
+        for sub in os.scandir(job_dir):
+            if sub.is_dir():
+                shutil.rmtree(sub.path, ignore_errors=True)
+        TASKS[task.id] = task
+        if not (job_dir / "input.zip").exists():
+            task.state = "error"; task.progress = 100; task.message = "Job interrompido (reinício do servidor)."
+            task.finished_at = time.time()
+            FINISHED.append(task.id)
+        else:
+            # volta pra fila na ordem original
+            task.state = "queued"; task.progress = 0; task.message = None; task.eta_seconds = None
+            task.seq = next(_ENQUEUE_SEQ)
+            QUEUE.put_nowait(task.id)
+        save_task(task)
+
+def _expired(task_id: str, cutoff: float) -> bool:
+    task = TASKS.get(task_id)
+    return task is None or (task.finished_at or 0) < cutoff
+
+# entra na chave do SITE_CACHE: deploy novo (código ou config de build) não serve zip antigo
+_SITE_CACHE_SALT = hashlib.blake2b(
+    b"\0".join([Path(__file__).read_bytes(), PKG_MGR.encode(), str(ZIP_LEVEL).encode(),
+                 os.getenv("npm_config_registry", "").encode()]),
+    digest_size=8).hexdigest()
+_LOCKFILES = ("package-lock.json", "pnpm-lock.yaml")
+
+def _site_cache_path(task: Task, input_zip: Path) -> Optional[Path]:
+    if SITE_CACHE_MAX <= 0 or not task.input_hash:
+        return None
+    # sem lockfile o npm resolve versões na hora: mesmo upload, build diferente amanhã.
+    # Só lê o diretório central do zip
+    with zipfile.ZipFile(input_zip) as z:
+        if not any(n.rsplit("/", 1)[-1] in _LOCKFILES for n in z.namelist()):
+            return None
+    return SITE_CACHE / f"{task.input_hash}-{_SITE_CACHE_SALT}-{task.slug}.zip"
+
+def site_cache_get(task: Task, input_zip: Path, out_zip: Path) -> bool:
+    try:
+        cached = _site_cache_path(task, input_zip)
+        if cached is None:
+            return False
+        os.link(cached, out_zip)
+        os.utime(cached)  # mtime = último uso, pra evicção
+        return True
+    except (OSError, zipfile.BadZipFile):
+        # zip inválido: a conversão normal reporta o erro
+        return False
+
+def site_cache_put(task: Task, input_zip: Path, out_zip: Path):
+    # best-effort: o job já está done, falha aqui não pode virar erro
+    try:
+        cached = _site_cache_path(task, input_zip)
+        if cached is None:
+            return
+        os.link(out_zip, cached)
+    except (OSError, zipfile.BadZipFile):
+        return  # já existe (outro worker) ou outro filesystem
+    entries = []
+    try:
+        for e in os.scandir(SITE_CACHE):
+            try:
+                entries.append((e.stat().st_mtime, e.path))
+            except OSError:
+                pass  # removido por outro worker no meio do caminho
+    except OSError:
+        return  # pasta sumiu, EMFILE...
+    entries.sort()
+    for _, path in entries[:-SITE_CACHE_MAX]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+async def evict_finished_tasks():
+    # TASKS não pode crescer pra sempre: descarta os finalizados mais antigos
+    # (acima de MAX_TASKS ou há mais de JOB_TTL_SECONDS); FINISHED está em ordem de término
+    cutoff = time.time() - JOB_TTL_SECONDS
+    dead = []
+    while FINISHED and (len(TASKS) > MAX_TASKS or _expired(FINISHED[0], cutoff)):
+        task_id = FINISHED.popleft()
+        TASKS.pop(task_id, None)
+        dead.append(JOBS_ROOT / task_id)
+    # apagar as pastas é I/O puro: fora do event loop, pra não travar os polls
+    for d in dead:
+        await asyncio.to_thread(shutil.rmtree, d, ignore_errors=True)
+
+def _orphan_job_dirs(cutoff: float):
+    # pastas em JOBS_ROOT sem task conhecida (upload abortado, task.json ilegível...)
+    out = []
+    for e in os.scandir(JOBS_ROOT):
+        if e.name in TASKS:
+            continue
+        try:
+            if e.is_dir() and e.stat().st_mtime < cutoff:
+                out.append(e.path)
+        except OSError:
+            pass  # o evict de um worker apagou no meio do caminho
+    return out
+
+async def janitor():
+    # TTL também vale sem jobs novos: o evict do worker_loop só roda ao fim de um job
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        # uma volta com erro não pode matar o janitor (create_task engoliria a exceção)
+        try:
+            await evict_finished_tasks()
+            for d in await asyncio.to_thread(_orphan_job_dirs, time.time() - JOB_TTL_SECONDS):
+                await asyncio.to_thread(shutil.rmtree, d, ignore_errors=True)
+        except Exception:
+            _LOG.exception("janitor: volta falhou, tenta de novo no próximo intervalo")
+
 async def worker_loop():
-    global WORKER_RUNNING
-    WORKER_RUNNING = True
+    global WORKER_RUNNING, LAST_STARTED_SEQ
+    WORKER_RUNNING += 1
     try:
         while True:
             task_id = await QUEUE.get()
@@ -308,84 +887,149 @@ async def worker_loop():
             if not task:
                 QUEUE.task_done()
                 continue
+            # a fila é FIFO: mesmo com vários workers o seq iniciado só cresce
+            LAST_STARTED_SEQ = task.seq
+            RUNNING_IDS.add(task_id)
             job_dir = JOBS_ROOT / task_id
             input_zip = job_dir / "input.zip"
             out_zip = job_dir / "site.zip"
             try:
                 task.state = "working"; task.progress = 10; task.message = "Validando e preparando..."
-                with tempfile.TemporaryDirectory(dir=job_dir) as tmp:
-                    tmp_path = Path(tmp)
-                    task.progress = 35; task.message = "Aplicando ajustes (slug/roteamento)..."
-                    result_zip = convert_lovable_zip(input_zip, task.slug, tmp_path)
-                    task.progress = 85; task.message  = "Gerando site.zip..."
-                    out_zip.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.move(str(result_zip), str(out_zip))
-                task.progress = 100; task.state = "done"
-                task.message = f"Pronto! ({int(out_zip.stat().st_size/1024)} KB)"
-                task.download_url = f"/download/{task_id}"; task.eta_seconds = 0
+                save_task(task)
+                if await asyncio.to_thread(site_cache_get, task, input_zip, out_zip):
+                    task.progress = 100; task.state = "done"
+                    task.message = f"Pronto! ({int(out_zip.stat().st_size/1024)} KB, do cache)"
+                    task.download_url = f"/download/{task_id}"; task.eta_seconds = 0
+                else:
+                    tmp_path = Path(tempfile.mkdtemp(dir=job_dir))
+                    try:
+                        result_zip = await run_conversion(task, input_zip, tmp_path)
+                        out_zip.parent.mkdir(parents=True, exist_ok=True)
+                        shutil.move(str(result_zip), str(out_zip))
+                        # done já aqui: o download não depende da limpeza do tmp
+                        task.progress = 100; task.state = "done"
+                        task.message = f"Pronto! ({int(out_zip.stat().st_size/1024)} KB)"
+                        task.download_url = f"/download/{task_id}"; task.eta_seconds = 0
+                        # grava já: um restart durante o cache/rmtree não pode reenfileirar o job
+                        task.finished_at = time.time()
+                        save_task(task)
+                        await asyncio.to_thread(site_cache_put, task, input_zip, out_zip)
+                    finally:
+                        # o tmp tem o projeto inteiro com node_modules: apagar leva segundos,
+                        # então sai do event loop pra não travar os polls (o worker só pega o
+                        # próximo job depois, pra não empilhar árvores no disco)
+                        await asyncio.to_thread(shutil.rmtree, tmp_path, ignore_errors=True)
             except subprocess.CalledProcessError as e:
                 task.state = "error"; task.message = f"Falha no build (npm): {e}"; task.progress = 100
             except FileNotFoundError as e:
                 task.state = "error"; task.message = f"FileNotFoundError: {e}"; task.progress = 100
             except Exception as e:
                 task.state = "error"; task.message = f"{type(e).__name__}: {e}"; task.progress = 100
+            finally:
+                RUNNING_IDS.discard(task_id)
+                # cancelado no shutdown fica "working" com o input.zip: o load_tasks reenfileira
+                if task.state in ("done", "error"):
+                    # o upload já foi consumido; não deixa o ZIP de entrada ocupando disco
+                    input_zip.unlink(missing_ok=True)
+                    task.finished_at = task.finished_at or time.time()
+                    FINISHED.append(task_id)
+                save_task(task)
+            await evict_finished_tasks()
             QUEUE.task_done()
     finally:
-        WORKER_RUNNING = False
+        WORKER_RUNNING -= 1
 
 @app.on_event("startup")
 async def _startup():
-    asyncio.create_task(worker_loop())
+    load_tasks()
+    await evict_finished_tasks()
+    asyncio.create_task(janitor())
+    for _ in range(WORKER_CONCURRENCY):
+        asyncio.create_task(worker_loop())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    if _MP_MANAGER is not None:
+        _MP_MANAGER.shutdown()
 
 # ---------- API ----------
+UPLOAD_BUFSIZE = 4 << 20
+
+def save_upload(src, dst: Path, limit: int):
+    # copia o SpooledTemporaryFile do Starlette pro disco; devolve (total de bytes, hash).
+    # Passou do limite: para na hora (sem Content-Length o file.size não ajuda).
+    # O hash sai na mesma passada e vira a chave do SITE_CACHE
+    total = 0
+    h = hashlib.blake2b(digest_size=16)
+    with open(dst, "wb") as f:
+        while chunk := src.read(UPLOAD_BUFSIZE):
+            total += len(chunk)
+            if total > limit:
+                break
+            h.update(chunk)
+            f.write(chunk)
+    return total, h.hexdigest()
+
 @app.post("/tasks")
 async def enqueue(slug: str = Form(...), file: UploadFile = File(...)):
+    slug = slug.strip()
+    if not _RE_SLUG.fullmatch(slug):
+        await file.close()
+        raise HTTPException(400, "Slug inválida: use só letras, números, - e _")
+    # o Starlette já sabe o tamanho do upload: recusa antes de copiar qualquer byte
+    if file.size is not None and file.size > MAX_UPLOAD_MB * 1024 * 1024:
+        await file.close()
+        raise HTTPException(413, f"Arquivo maior que {MAX_UPLOAD_MB} MB")
     task_id = str(uuid.uuid4())
     job_dir = JOBS_ROOT / task_id
     job_dir.mkdir(parents=True, exist_ok=True)
     input_zip = job_dir / "input.zip"
 
-    # salva upload
-    total = 0
-    with open(input_zip, "wb") as f:
-        while True:
-            chunk = await file.read(1024 * 1024)
-            if not chunk:
-                break
-            total += len(chunk)
-            f.write(chunk)
+    # salva upload: a cópia inteira numa thread, em vez de um await + write por MiB no loop
+    limit = MAX_UPLOAD_MB * 1024 * 1024
+    total, input_hash = await asyncio.to_thread(save_upload, file.file, input_zip, limit)
+    # libera o SpooledTemporaryFile do Starlette já na resposta
+    await file.close()
 
-    if total > MAX_UPLOAD_MB * 1024 * 1024:
-        try:
-            input_zip.unlink()
-        finally:
-            pass
+    if total > limit:
+        shutil.rmtree(job_dir, ignore_errors=True)
         raise HTTPException(413, f"Arquivo maior que {MAX_UPLOAD_MB} MB")
 
-    task = Task(id=task_id, slug=slug.strip(), state="queued", progress=0, eta_seconds=None)
+    task = Task(id=task_id, slug=slug, state="queued", progress=0, eta_seconds=None,
+                seq=next(_ENQUEUE_SEQ), input_hash=input_hash)
     TASKS[task_id] = task
+    save_task(task)
     await QUEUE.put(task_id)
     return {"task_id": task_id}
 
-@app.get("/tasks/{task_id}")
+@app.get("/tasks/{task_id}", response_model=TaskStatus)
 async def status(task_id: str):
     task = TASKS.get(task_id)
     if not task:
         raise HTTPException(404, "Task não encontrada")
     if task.state == "queued":
-        try:
-            position = max(0, QUEUE.qsize() - 1)
-        except Exception:
-            position = 0
-        task.eta_seconds = 60 * (position + 1)
+        ahead = max(0, task.seq - LAST_STARTED_SEQ - 1) + len(RUNNING_IDS)
+        # WORKER_CONCURRENCY jobs andam juntos: cada "rodada" de ~60s drena esse tanto
+        task.eta_seconds = 60 * (ahead // WORKER_CONCURRENCY + 1)
     elif task.state == "working" and (task.eta_seconds is None or task.eta_seconds > 10):
         task.eta_seconds = max(10, int((100 - task.progress) * 1.2))
-    return JSONResponse(task.model_dump())
+    # dict direto pro orjson: TaskStatus fica só como schema, sem validar a cada poll
+    return ORJSONResponse({
+        "id": task.id, "slug": task.slug, "state": task.state, "progress": task.progress,
+        "eta_seconds": task.eta_seconds, "message": task.message, "download_url": task.download_url,
+    })
 
 @app.get("/download/{task_id}")
 async def download(task_id: str):
     job_dir = JOBS_ROOT / task_id
     out_zip = job_dir / "site.zip"
-    if not out_zip.exists():
+    # um stat só: serve de checagem de existência e vai pro FileResponse, que não refaz
+    try:
+        st = os.stat(out_zip)
+    except FileNotFoundError:
         raise HTTPException(404, "site.zip não encontrado (o job terminou com erro ou foi limpo).")
-    return FileResponse(path=str(out_zip), media_type="application/zip", filename="site.zip")
+    # o site.zip de um id nunca muda: o navegador pode reaproveitar até o job expirar
+    return FileResponse(path=str(out_zip), media_type="application/zip", filename="site.zip",
+                        stat_result=st,
+                        headers={"Cache-Control": f"private, max-age={JOB_TTL_SECONDS}"})